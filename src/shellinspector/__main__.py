@@ -1,4 +1,5 @@
 import argparse
+import functools
 import logging
 import re
 import sys
@@ -10,17 +11,20 @@ from shellinspector.runner import ShellRunner
 
 LOGGER = logging.getLogger(Path(__file__).name)
 
+RE_ANSIBLE_PORT = re.compile(rb"ansible_port=([0-9]+)")
+
 
 def get_vagrant_sshport():
     inventory_file = Path(
         ".vagrant/provisioners/ansible/inventory/vagrant_ansible_inventory"
     )
 
-    if not inventory_file.exists():
+    try:
+        content = inventory_file.read_bytes()
+    except FileNotFoundError:
         return None
 
-    content = inventory_file.read_text()
-    port = re.search("ansible_port=([0-9]+)", content)
+    port = RE_ANSIBLE_PORT.search(content)
     if not port:
         raise Exception(
             "vagrant_ansible_inventory is invalid, could not find ansible_port"
@@ -28,7 +32,8 @@ def get_vagrant_sshport():
     return int(port[1])
 
 
-def get_ssh_config(target_host):
+@functools.cache
+def _get_ssh_config(target_host):
     if target_host == "vagrant":
         return {
             "server": "127.0.0.1",
@@ -44,20 +49,30 @@ def get_ssh_config(target_host):
         }
 
 
+def get_ssh_config(target_host):
+    # callers add keys to the config, so don't hand out the cached dict
+    return dict(_get_ssh_config(target_host))
+
+
 def parse_spec_file(path):
     LOGGER.debug("parsing %s", path)
 
     spec_file = Path(path).resolve()
 
-    if not spec_file.exists():
+    try:
+        f = open(spec_file)
+    except FileNotFoundError:
         LOGGER.error("file %s does not exist", spec_file)
         return None
 
-    with open(spec_file) as f:
+    # always parse again, even for files listed more than once: each run
+    # needs its own random SI_TEST_USER
+    with f:
         specfile = parse(spec_file, f)
 
-    for i, command in enumerate(specfile.commands):
-        LOGGER.debug("command[%s]: %s", i, command.short)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        for i, command in enumerate(specfile.commands):
+            LOGGER.debug("command[%s]: %s", i, command.short)
 
     if specfile.errors:
         for error in specfile.errors:
@@ -90,9 +105,7 @@ def run(target_host, spec_file_paths, identity, verbose):
 
     spec_files = []
 
-    for spec_file_path in spec_file_paths:
-        spec_file = parse_spec_file(spec_file_path)
-
+    for spec_file in map(parse_spec_file, spec_file_paths):
         if spec_file is None or spec_file.errors:
             continue
 
@@ -102,17 +115,21 @@ def run(target_host, spec_file_paths, identity, verbose):
         else:
             spec_files.append(spec_file)
 
-    for spec_file in spec_files:
-        if len(spec_files) > 1:
-            if spec_file.applied_example:
-                example_str = ",".join(
-                    f"{k}={v}" for k, v in spec_file.applied_example.items()
-                )
-                print(f"{spec_file.path} (w/ {example_str})")
-            else:
-                print(f"{spec_file.path}")
-
-        success = success & runner.run(spec_file)
+    print_names = len(spec_files) > 1
+
+    with runner:
+        for spec_file in spec_files:
+            if print_names:
+                if spec_file.applied_example:
+                    example_str = ",".join(
+                        f"{k}={v}" for k, v in spec_file.applied_example.items()
+                    )
+                    print(f"{spec_file.path} (w/ {example_str})")
+                else:
+                    print(f"{spec_file.path}")
+
+            if not runner.run(spec_file):
+                success = False
 
     return 0 if success else 1
 
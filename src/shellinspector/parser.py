@@ -1,13 +1,33 @@
 import dataclasses
+import functools
+import io
 import math
+import os
 import random
 import re
+import sys
 import typing
-from contextlib import suppress
 from enum import Enum
 from pathlib import Path
 
-import yaml
+
+@functools.cache
+def _yaml_loader():
+    # importing yaml takes a while, only do it once a file with frontmatter
+    # or a global config turns up
+    import yaml
+
+    # the libyaml based loader is a lot faster, but not always available
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    # same as yaml.load(), without needing the yaml module here
+    loader = _yaml_loader()(stream)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
 
 
 class ExecutionMode(Enum):
@@ -22,8 +42,32 @@ class AssertMode(Enum):
     IGNORE = "_"
 
 
+# prefix characters to enum members, dict lookups are a lot cheaper than
+# calling the Enum classes
+EXECUTION_MODES = {m.value: m for m in ExecutionMode}
+ASSERT_MODES = {m.value: m for m in AssertMode}
+# no assert_mode in the prefix means LITERAL
+ASSERT_MODES[""] = AssertMode.LITERAL
+
+
+# explicit __slots__ instead of dataclass(slots=True), which needs py3.10.
+# There are thousands of commands in a larger test suite, slots save the
+# per-instance __dict__.
 @dataclasses.dataclass
 class Command:
+    __slots__ = (
+        "execution_mode",
+        "command",
+        "user",
+        "session_name",
+        "host",
+        "assert_mode",
+        "expected",
+        "source_file",
+        "source_line_no",
+        "line",
+    )
+
     execution_mode: ExecutionMode
     command: str
     user: str
@@ -37,27 +81,49 @@ class Command:
 
     @property
     def line_count(self):
-        # TODO: replace this with .removesuffix("\n").count("\n")+1 once we drop py3.7
-        count = self.expected.count("\n")
-        if self.expected and self.expected[-1] != "\n":
-            count += 1
-        return count
+        if not self.expected:
+            return 0
+        return self.expected.removesuffix("\n").count("\n") + 1
 
     @property
     def short(self):
         return f"{self.execution_mode.name}({self.user}@{self.host}) `{self.command}` (expect {self.line_count} lines, {self.assert_mode.name})"
 
+    def copy(self):
+        # a lot faster than dataclasses.replace() or copy.copy()
+        return Command(
+            self.execution_mode,
+            self.command,
+            self.user,
+            self.session_name,
+            self.host,
+            self.assert_mode,
+            self.expected,
+            self.source_file,
+            self.source_line_no,
+            self.line,
+        )
+
 
 @dataclasses.dataclass
 class Error:
+    __slots__ = ("source_file", "source_line_no", "source_line", "message")
+
     source_file: Path
     source_line_no: int
     source_line: str
     message: str
 
+    def copy(self):
+        return Error(
+            self.source_file, self.source_line_no, self.source_line, self.message
+        )
+
 
 @dataclasses.dataclass
 class Settings:
+    __slots__ = ("timeout_seconds", "include_dirs", "fixture_dirs")
+
     timeout_seconds: int
     include_dirs: list[Path]
     fixture_dirs: list[Path]
@@ -67,9 +133,33 @@ class Settings:
         self.include_dirs = []
         self.fixture_dirs = []
 
+    def copy(self):
+        copy = Settings(self.timeout_seconds)
+        copy.include_dirs = self.include_dirs.copy()
+        copy.fixture_dirs = self.fixture_dirs.copy()
+        return copy
+
+
+SETTINGS_FIELDS = dataclasses.fields(Settings)
+# settings containing lists of paths, relative to the file they are set in
+SETTINGS_PATH_KEYS = frozenset(["include_dirs", "fixture_dirs"])
+
 
 @dataclasses.dataclass
 class Specfile:
+    __slots__ = (
+        "path",
+        "commands",
+        "errors",
+        "environment",
+        "examples",
+        "fixture",
+        "fixture_specfile_pre",
+        "fixture_specfile_post",
+        "applied_example",
+        "settings",
+    )
+
     path: Path
     commands: list[Command]
     errors: list[Error]
@@ -96,26 +186,38 @@ class Specfile:
         self.settings = Settings()
 
     def copy(self):
-        return Specfile(
+        copy = Specfile(
             self.path,
-            [dataclasses.replace(c) for c in self.commands],
-            [dataclasses.replace(e) for e in self.errors],
+            [c.copy() for c in self.commands],
+            [e.copy() for e in self.errors],
             self.environment.copy(),
             [e.copy() for e in self.examples],
         )
+        copy.fixture = self.fixture
+        if self.fixture_specfile_pre:
+            copy.fixture_specfile_pre = self.fixture_specfile_pre.copy()
+        if self.fixture_specfile_post:
+            copy.fixture_specfile_post = self.fixture_specfile_post.copy()
+        copy.settings = self.settings.copy()
+        return copy
 
     def as_example(self, example):
         copy = self.copy()
         copy.applied_example = example
 
+        # format_map() uses the dict as-is, format(**example) copies it
         for cmd in copy.commands:
-            cmd.command = cmd.command.format(**example)
-            cmd.line = cmd.line.format(**example)
-            cmd.expected = cmd.expected.format(**example)
+            cmd.command = cmd.command.format_map(example)
+            cmd.line = cmd.line.format_map(example)
+            cmd.expected = cmd.expected.format_map(example)
 
         return copy
 
 
+# characters of the execution and assert modes, as used in command prefixes
+EXECUTION_MODE_CHARS = "".join(m.value for m in ExecutionMode)
+ASSERT_MODE_CHARS = "".join(m.value for m in AssertMode)
+
 # parse a line like
 #   [user@host]$ ls
 # into ("user", "host", "$")
@@ -129,30 +231,38 @@ RE_PREFIX = re.compile(
     r"(?P<host>[a-z]+)?"
     r"\])?"
     # $ or %
-    rf"(?P<execution_mode>[{''.join(m.value for m in ExecutionMode)}])"
+    rf"(?P<execution_mode>[{EXECUTION_MODE_CHARS}])"
     # nothing or _ or ~ or
-    rf"(?P<assert_mode>[{''.join(m.value for m in AssertMode)}]?)"
+    rf"(?P<assert_mode>[{ASSERT_MODE_CHARS}]?)"
     " "
 )
 
+# a line containing only '---', ending the frontmatter
+RE_FRONTMATTER_END = re.compile(r"^---[ \t\r]*$\n?", re.MULTILINE)
+
+# characters a line matching RE_PREFIX can start with
+PREFIX_START_CHARS = frozenset("[" + EXECUTION_MODE_CHARS)
+
+# marks keys missing from the frontmatter or global config, None is a valid value
+_MISSING = object()
+
 
 def parse_yaml_multidoc(stream: typing.IO) -> tuple[dict, str]:
-    if stream.read(3) != "---":
-        stream.seek(0)
-        return {}, stream.read()
-    else:
-        stream.seek(0)
+    content = stream.read()
 
-    loader = yaml.SafeLoader(stream)
+    if not content.startswith("---"):
+        return {}, content
 
-    try:
-        # load the 1st document (up to '---') as yaml ...
-        frontmatter = loader.get_data()
-        # ... and the rest as plain text, to be parsed later,
-        # minus \x00 at the end added by the yaml parser as EOF
-        commands = loader.buffer[loader.pointer + 1 : -1]
-    finally:
-        loader.dispose()
+    # the 1st document (up to the next '---') is the yaml frontmatter ...
+    end = RE_FRONTMATTER_END.search(content, 3)
+
+    if end:
+        # ... and the rest plain text, to be parsed later
+        frontmatter = load_yaml(content[: end.start()])
+        commands = content[end.end() :]
+    else:
+        frontmatter = load_yaml(content)
+        commands = ""
 
     if frontmatter is None:
         frontmatter = {}
@@ -160,11 +270,18 @@ def parse_yaml_multidoc(stream: typing.IO) -> tuple[dict, str]:
     return frontmatter, commands
 
 
+@functools.lru_cache(maxsize=4096)
+def _resolve_include(include_dir: Path, file_path: Path) -> Path:
+    # resolve() stats every path component, the same includes are looked up
+    # in the same directories over and over again
+    return (include_dir / file_path).resolve()
+
+
 def include_file(
     specfile: Specfile, line_no, line, dirs: list[Path], file_path: Path
 ) -> typing.Optional[Specfile]:
     for include_dir in dirs:
-        include_path = (include_dir / file_path).resolve()
+        include_path = _resolve_include(include_dir, file_path)
 
         try:
             with open(include_path) as f:
@@ -172,36 +289,72 @@ def include_file(
         except FileNotFoundError:
             continue
 
-        break
-    else:
-        dirs_str = [str(d) for d in dirs]
-        specfile.errors.append(
-            Error(
-                specfile.path,
-                line_no,
-                line,
-                f"error: {file_path} does not exist in any directory: {','.join(dirs_str)}",
-            )
+    dirs_str = [str(d) for d in dirs]
+    specfile.errors.append(
+        Error(
+            specfile.path,
+            line_no,
+            line,
+            f"error: {file_path} does not exist in any directory: {','.join(dirs_str)}",
         )
+    )
+    return None
 
 
 def parse_commands(specfile: Specfile, commands: str) -> None:
-    for line_no, line in enumerate(commands.splitlines(), 1):
+    # output lines of the last command, collected and joined once to avoid
+    # quadratic string concatenation for long expected outputs
+    output = []
+
+    def flush_output():
+        if output:
+            specfile.commands[-1].expected += "\n".join(output) + "\n"
+            output.clear()
+
+    def finish_command():
+        # called once the last command can't get any more output
+        flush_output()
+        if specfile.commands:
+            cmd = specfile.commands[-1]
+            if cmd.assert_mode == AssertMode.REGEX:
+                # remove trailing new lines for regexes, see syntax.md
+                cmd.expected = cmd.expected.rstrip("\n")
+
+    # last command per execution mode, to inherit user and host from
+    last_by_mode = {}
+
+    # bound once, instead of looking up the global and attribute per line
+    match_prefix = RE_PREFIX.match
+
+    # iterate lazily instead of building a list of all lines up front
+    for line_no, line in enumerate(io.StringIO(commands, newline=None), 1):
+        line = line.rstrip("\n")
+        first_char = line[:1]
+
         # comment
-        if line.startswith("#"):
+        if first_char == "#":
             continue
 
         # include
-        if line.startswith("<"):
+        if first_char == "<":
+            flush_output()
             included_specfile = include_file(
                 specfile, line_no, line, specfile.settings.include_dirs, Path(line[1:])
             )
             if included_specfile:
                 specfile.errors.extend(included_specfile.errors)
+                if included_specfile.commands:
+                    finish_command()
                 specfile.commands.extend(included_specfile.commands)
+                for cmd in included_specfile.commands:
+                    last_by_mode[cmd.execution_mode] = cmd
             continue
 
-        prefix = RE_PREFIX.match(line)
+        # skip the regex for plain output lines, which can't have a prefix
+        if first_char in PREFIX_START_CHARS:
+            prefix = match_prefix(line)
+        else:
+            prefix = None
 
         # output before very first command
         if not prefix and not specfile.commands:
@@ -217,75 +370,85 @@ def parse_commands(specfile: Specfile, commands: str) -> None:
 
         # start of a new command
         if prefix:
-            command = line[prefix.span()[1] :]
-            user, session_name, host, execution_mode, assert_mode = prefix.group(
-                "user", "session_name", "host", "execution_mode", "assert_mode"
-            )
+            command = line[prefix.end() :]
+            # groups in the order they appear in RE_PREFIX
+            user, session_name, host, execution_mode, assert_mode = prefix.groups()
 
-            execution_mode = ExecutionMode(execution_mode)
-            assert_mode = AssertMode(
-                assert_mode if assert_mode else AssertMode.LITERAL.value
-            )
+            # there are only a handful of distinct users, sessions and hosts,
+            # share one string object for each instead of one per command
+            user = user and sys.intern(user)
+            session_name = session_name and sys.intern(session_name)
+            host = host and sys.intern(host)
+
+            execution_mode = EXECUTION_MODES[execution_mode]
+            assert_mode = ASSERT_MODES[assert_mode]
 
             if execution_mode == ExecutionMode.ROOT:
                 user = "root"
 
-            # reuse user and host from last command if not specified
-            try:
-                last_command = next(
-                    cmd
-                    for cmd in reversed(specfile.commands)
-                    if cmd.execution_mode == execution_mode
-                    or execution_mode == ExecutionMode.PYTHON
-                )
+            # reuse user and host from last command if not specified, python
+            # commands use the last command of any mode
+            if execution_mode == ExecutionMode.PYTHON:
+                last_command = specfile.commands[-1] if specfile.commands else None
+            else:
+                last_command = last_by_mode.get(execution_mode)
+
+            if last_command:
                 user = user or last_command.user
                 host = host or last_command.host
-            except (StopIteration, IndexError):
+            else:
                 host = host or "remote"
 
             if not user and execution_mode == ExecutionMode.USER and host != "local":
                 # default to randomly generated test user name
                 user = specfile.environment["SI_TEST_USER"]
 
-            specfile.commands.append(
-                Command(
-                    execution_mode,
-                    command,
-                    user,
-                    session_name,
-                    host,
-                    assert_mode,
-                    "",
-                    specfile.path,
-                    line_no,
-                    line,
-                )
+            finish_command()
+            command = Command(
+                execution_mode,
+                command,
+                user,
+                session_name,
+                host,
+                assert_mode,
+                "",
+                specfile.path,
+                line_no,
+                line,
             )
+            specfile.commands.append(command)
+            last_by_mode[execution_mode] = command
         else:
             # add output line to last command
-            specfile.commands[-1].expected += line + "\n"
+            output.append(line)
 
-    for cmd in specfile.commands:
-        if cmd.assert_mode == AssertMode.REGEX:
-            # remove trailing new lines for regexes, see syntax.md
-            cmd.expected = cmd.expected.rstrip("\n")
+    finish_command()
 
 
 def parse_global_config(
     ispec_path: typing.Union[str, Path]
 ) -> tuple[dict, typing.Optional[Path]]:
-    search_path = Path(ispec_path)
+    # work on plain strings, this runs for every parsed file and would
+    # otherwise create a few Path objects per directory level
+    search_path = os.fspath(ispec_path)
 
-    while str(search_path) != search_path.root:
-        search_path = Path(search_path).parent
+    while True:
+        parent = os.path.dirname(search_path)
+
+        # reached the root (or the cwd, for relative paths)
+        if parent == search_path:
+            break
+
+        search_path = parent
+        config_path = os.path.join(search_path, "shellinspector.yaml")
 
         try:
-            with open(search_path / "shellinspector.yaml") as f:
-                return yaml.safe_load(f), search_path / "shellinspector.yaml"
+            with open(config_path) as f:
+                return load_yaml(f), Path(config_path)
         except FileNotFoundError:
             pass
 
-        if (search_path / ".git").exists():
+        if os.path.exists(os.path.join(search_path, ".git")):
             break
 
     return {}, None
@@ -305,9 +468,8 @@ def parse(
 
     # use values in frontmatter if they exist, otherwise use global config
     for key in ["examples", "environment", "fixture"]:
-        try:
-            value = frontmatter[key]
-        except LookupError:
+        value = frontmatter.get(key, _MISSING)
+        if value is _MISSING:
             value = config.get(key, None)
 
         if value is not None:
@@ -316,20 +478,20 @@ def parse(
     frontmatter_settings = frontmatter.get("settings", {})
     global_settings = config.get("settings", {})
 
-    path_setting_keys = ["include_dirs", "fixture_dirs"]
+    for key in SETTINGS_FIELDS:
+        value = frontmatter_settings.get(key.name, _MISSING)
 
-    for key in dataclasses.fields(specfile.settings):
-        value = None
-
-        with suppress(LookupError):
-            value = global_settings[key.name]
-            root_path = config_path.parent
-
-        with suppress(LookupError):
-            value = frontmatter_settings[key.name]
+        if value is not _MISSING:
             root_path = specfile.path.parent
+        else:
+            value = global_settings.get(key.name, _MISSING)
+
+            if value is not _MISSING:
+                root_path = config_path.parent
+            else:
+                value = None
 
-        if key.name in path_setting_keys:
+        if key.name in SETTINGS_PATH_KEYS:
             value = value or getattr(specfile.settings, key.name)
             value = [(root_path / Path(p)).resolve() for p in value]
             value.append(specfile.path.parent)
@@ -9,17 +9,43 @@ from shellinspector.runner import RunnerEvent
 
 LOGGER = logging.getLogger(Path(__file__).name)
 
+COLORS = ["light_grey", "red", "green", "white"]
+# prefix for lines of expected and actual output
+INDENT = "    "
+
 
 class ConsoleReporter:
     def __init__(self):
         self.has_unfinished_line = False
 
-    def print_indented(self, prefix, text, color):
+        # colored() checks the environment and whether stdout is a tty on
+        # every call. Do that once and keep the escape sequences around.
+        self.colors = {}
+        for color in COLORS:
+            start, _, end = colored("X", color).partition("X")
+            self.colors[color] = (start, end)
+
+        self.handlers = {
+            RunnerEvent.COMMAND_STARTING: self.on_command_starting,
+            RunnerEvent.ERROR: self.on_error,
+            RunnerEvent.COMMAND_PASSED: self.on_command_passed,
+            RunnerEvent.COMMAND_FAILED: self.on_command_failed,
+        }
+
+    def colored(self, text, color):
+        start, end = self.colors[color]
+        return f"{start}{text}{end}"
+
+    def format_indented(self, prefix, text, color):
         if not text:
-            prefix += " (none)"
-        print(colored(prefix, "light_grey"))
-        for line in text.splitlines():
-            print(colored(f"{' ' * 3} {line.strip()}", color))
+            return [self.colored(f"{prefix} (none)", "light_grey")]
+
+        lines = [self.colored(prefix, "light_grey")]
+        lines += [
+            self.colored(f"{INDENT}{line.rstrip()}", color)
+            for line in text.splitlines()
+        ]
+        return lines
 
     def reset_line(self):
         if "TERM" in os.environ:
@@ -32,33 +58,53 @@ class ConsoleReporter:
             self.has_unfinished_line = True
         elif self.has_unfinished_line:
             self.reset_line()
+            self.has_unfinished_line = False
 
         print(*args, **kwargs)
 
         if self.has_unfinished_line:
+            # no newline at the end, make sure the line is shown anyway
             sys.stdout.flush()
 
+    def print_lines(self, lines):
+        # one write for all lines of an event instead of one print() per line
+        self.print("\n".join(lines))
+
+    def on_command_starting(self, cmd, **kwargs):
+        if logging.root.level > logging.DEBUG:
+            end = ""
+        else:
+            end = "\n"
+        self.print(self.colored(f"RUN  {cmd.line}", "light_grey"), end=end)
+
+    def on_error(self, cmd, **kwargs):
+        lines = [
+            self.colored(f"ERR  {cmd.line}", "red"),
+            self.colored("  " + kwargs["message"], "red"),
+        ]
+        lines += self.format_indented(
+            "  output before giving up:", kwargs["actual"], "red"
+        )
+        self.print_lines(lines)
+
+    def on_command_passed(self, cmd, **kwargs):
+        self.print(self.colored(f"PASS {cmd.line}", "green"))
+
+    def on_command_failed(self, cmd, **kwargs):
+        lines = [self.colored(f"FAIL {cmd.line}", "red")]
+        if "returncode" in kwargs["reasons"]:
+            rc = kwargs["returncode"]
+            lines.append(self.colored("  command failed", "red"))
+            lines.append(self.colored("    expected: 0", "light_grey"))
+            lines.append(self.colored(f"    actual:   {rc}", "light_grey"))
+        if "output" in kwargs["reasons"]:
+            lines.append(self.colored("  output did not match", "red"))
+            lines += self.format_indented("    expected:", cmd.expected, "light_grey")
+            lines += self.format_indented("    actual:", kwargs["actual"], "white")
+        self.print_lines(lines)
+
     def __call__(self, event, cmd, **kwargs):
-        if event == RunnerEvent.COMMAND_STARTING:
-            if logging.root.level > logging.DEBUG:
-                end = ""
-            else:
-                end = "\n"
-            self.print(colored(f"RUN  {cmd.line}", "light_grey"), end=end)
-        elif event == RunnerEvent.ERROR:
-            self.print(colored(f"ERR  {cmd.line}", "red"))
-            self.print(colored("  " + kwargs["message"], "red"))
-            self.print_indented("  output before giving up:", kwargs["actual"], "red")
-        elif event == RunnerEvent.COMMAND_PASSED:
-            self.print(colored(f"PASS {cmd.line}", "green"))
-        elif event == RunnerEvent.COMMAND_FAILED:
-            self.print(colored(f"FAIL {cmd.line}", "red"))
-            if "returncode" in kwargs["reasons"]:
-                rc = kwargs["returncode"]
-                self.print(colored("  command failed", "red"))
-                self.print(colored("    expected: 0", "light_grey"))
-                self.print(colored(f"    actual:   {rc}", "light_grey"))
-            if "output" in kwargs["reasons"]:
-                self.print(colored("  output did not match", "red"))
-                self.print_indented("    expected:", cmd.expected, "light_grey")
-                self.print_indented("    actual:", kwargs["actual"], "white")
+        # events without a handler aren't shown
+        handler = self.handlers.get(event)
+        if handler:
+            handler(cmd, **kwargs)
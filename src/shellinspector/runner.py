@@ -3,12 +3,15 @@
 import ast
 import dataclasses
 import enum
+import functools
 import logging
 import os
 import re
 import shlex
+import shutil
+import subprocess
 import sys
-from contextlib import contextmanager
+import tempfile
 from pathlib import Path
 
 from pexpect import pxssh
@@ -34,16 +37,16 @@ class ShellinspectorPyContext:
     env: dict
 
 
-def run_in_file(filename: Path, si_context: dict, code: str):
-    """
-    Load the python code within `filename` and run the given python code within.
-    Additionally, set all values in si_context as global variables. The code
-    within `code` must be a single function call. Its return value will be
-    returned by this function.
-    """
+@functools.lru_cache(maxsize=64)
+def _compile_python_file(filename: Path, mtime_ns: int, size: int):
+    # mtime_ns and size are only part of the cache key, so changed files are
+    # compiled again
     with open(filename) as f:
-        node = ast.parse(f.read(), filename)
+        return compile(f.read(), filename, "exec")
+
 
+@functools.lru_cache(maxsize=256)
+def _compile_call(code: str, filename: Path):
     call_ast = ast.parse(code)
 
     if len(call_ast.body) != 1:
@@ -58,26 +61,35 @@ def run_in_file(filename: Path, si_context: dict, code: str):
             f"Only function calls are supported, you provided {call}"
         )
 
+    # add an extra argument in front passing the given si_context
     call.args.insert(0, ast.Name(id="context", ctx=ast.Load()))
 
-    # add function call for the given function_name and args,
-    # also add an extra argument in front passing the given si_context.
-    call = ast.Assign(
-        targets=[ast.Name(id="_return_value", ctx=ast.Store())],
-        value=call,
-    )
-
-    node.body.append(call)
+    node = ast.Expression(body=call)
     ast.fix_missing_locations(node)
 
+    return compile(node, filename=filename, mode="eval")
+
+
+def run_in_file(filename: Path, si_context: dict, code: str):
+    """
+    Load the python code within `filename` and run the given python code within.
+    Additionally, set all values in si_context as global variables. The code
+    within `code` must be a single function call. Its return value will be
+    returned by this function.
+    """
+    stat = os.stat(filename)
+    module = _compile_python_file(filename, stat.st_mtime_ns, stat.st_size)
+    call = _compile_call(code, filename)
+
     globalz = {
         "context": si_context,
     }
 
-    obj = compile(node, filename=filename, mode="exec")
-    exec(obj, globalz, globalz)
+    # run the module in fresh globals every time, only parsing and compiling
+    # is cached
+    exec(module, globalz, globalz)
 
-    return globalz["_return_value"]
+    return eval(call, globalz, globalz)
 
 
 class RemoteShell(pxssh.pxssh):
@@ -85,49 +97,69 @@ class RemoteShell(pxssh.pxssh):
         # ignoring the echoed commands doesn't seem to work for local commands
         # just disabling echo is easier than debugging this.
         kwargs["echo"] = False
+        # disable any color output, without touching our own environment
+        kwargs.setdefault("env", {**os.environ, "TERM": "dumb"})
+        # let pexpect decode output as it reads it, so .before is a str
+        kwargs.setdefault("encoding", "utf-8")
+        kwargs.setdefault("codec_errors", "replace")
         super().__init__(*args, **kwargs)
 
+        # Put the return code of the last command into the prompt, so we get
+        # it together with the output instead of running `echo $?` after each
+        # command. This also applies to nested shells, see push_state().
+        self.UNIQUE_PROMPT = r"\[PEXPECT\](?P<returncode>[0-9]+)[\$\#] "
+        self.PROMPT = self.UNIQUE_PROMPT
+        self.PROMPT_SET_SH = r"PS1='[PEXPECT]$?\$ '"
+        # used by pxssh if the login shell is csh/tcsh, %? is the return code
+        self.PROMPT_SET_CSH = r"set prompt='[PEXPECT]%?\$ '"
+
         self.push_depth = 0
 
     def run_command(self, line):
+        """Run the given command, return its output and return code."""
         self.sendline(line)
         found_prompt = self.prompt()
-        actual_output = self.before.decode()
-        actual_output = actual_output.replace("\r\n", "\n")
+        actual_output = self.before.replace("\r\n", "\n")
 
         if found_prompt:
-            return actual_output
+            return actual_output, int(self.match.group("returncode"))
         else:
             self.close()
             raise TimeoutException(actual_output)
 
     def set_environment(self, context):
-        for k, v in context.items():
-            self.sendline(f"export {k}={shlex.quote(str(v))}")
-            assert self.prompt()
+        if not context:
+            return
+
+        # one export for all variables, so we only wait for a single prompt
+        exports = " ".join(f"{k}={shlex.quote(str(v))}" for k, v in context.items())
+        self.sendline(f"export {exports}")
+        assert self.prompt()
 
     def get_environment(self):
-        output = self.run_command("export")
+        # NUL-separated, so values can contain anything (but NUL) without
+        # having to parse shell quoting
+        output, _ = self.run_command("env -0")
 
         env = {}
 
-        for line in output.splitlines():
-            line = line.removeprefix("export ")
-            line = line.removeprefix("declare -x ")
-            k, _, v = line.partition("=")
+        for line in output.split("\0"):
+            k, sep, v = line.partition("=")
 
-            if not v:
-                continue
+            if sep:
+                env[k] = v
 
-            env[k] = " ".join(shlex.split(v))
+        # set by bash for the env command itself
+        env.pop("_", None)
 
         return env
 
-    def push_state(self):
+    def push_state(self, env=None):
         self.push_depth += 1
 
-        # launch a child shell so we can easily reset the environment variables
-        self.sendline("bash")
+        # Launch a child shell so we can easily reset the environment
+        # variables.
+        self.sendline(f"env SHELLINSPECTOR_PROMPT_STATE={self.push_depth} bash")
 
         # new shell means new prompt, so reconfigure the prompt recognition
         self.set_unique_prompt()
@@ -135,8 +167,9 @@ class RemoteShell(pxssh.pxssh):
         self.sendline("")
         assert self.prompt()
 
-        self.sendline(f"export SHELLINSPECTOR_PROMPT_STATE={self.push_depth}")
-        assert self.prompt()
+        # Export the variables inside the new shell. Passing them to env above
+        # would make them visible to other users on the host via ps.
+        self.set_environment(env)
 
     def pop_state(self):
         if self.closed:
@@ -144,7 +177,7 @@ class RemoteShell(pxssh.pxssh):
 
         self.sendline("echo $SHELLINSPECTOR_PROMPT_STATE")
         assert self.prompt()
-        out = self.before.decode().strip()
+        out = self.before.strip()
 
         if not out or int(out) != self.push_depth:
             raise Exception(
@@ -190,35 +223,66 @@ class LocalShell(RemoteShell):
         return True
 
 
-@contextmanager
-def disable_color():
-    if "TERM" in os.environ:
-        old_term = os.environ["TERM"]
-    else:
-        old_term = None
+# sun_path is 108 bytes on Linux but only 104 on macOS, including the NUL
+SSH_CONTROL_PATH_MAX = 103
+# %C is a 40 character hash, and ssh appends a random ".XXXXXXXXXXXXXXXX"
+# while the master binds the socket
+SSH_CONTROL_NAME_LEN = 40 + 17
+
 
-    os.environ["TERM"] = "dumb"  # disable any color ouput in SSH
+def get_ssh_options(control_dir):
+    if control_dir is None:
+        return {}
 
-    yield
+    control_path_len = len(os.fsencode(control_dir)) + 1 + SSH_CONTROL_NAME_LEN
+    if control_path_len > SSH_CONTROL_PATH_MAX:
+        LOGGER.debug("not sharing SSH connections, path too long: %s", control_dir)
+        return {}
+
+    # Share one SSH connection between all sessions for the same user and
+    # host, so only the first one has to do the full key exchange and
+    # authentication. The master outlives the session which started it,
+    # but only briefly: ShellRunner.close() stops it at the end of the run.
+    return {
+        "ControlMaster": "auto",
+        # %C is a hash of host, port and user
+        "ControlPath": str(Path(control_dir) / "%C"),
+        "ControlPersist": "5s",
+    }
 
-    if old_term is not None:
-        os.environ["TERM"] = old_term
-    else:
-        del os.environ["TERM"]
 
+def get_ssh_session(ssh_config, timeout_seconds, control_dir=None):
+    options = get_ssh_options(control_dir)
+    shell = RemoteShell(timeout=timeout_seconds, options=options)
+    shell.login(**ssh_config)
+    return shell
 
-def get_ssh_session(ssh_config, timeout_seconds):
-    with disable_color():
-        shell = RemoteShell(timeout=timeout_seconds)
-        shell.login(**ssh_config)
-        return shell
+
+def get_ssh_control_dir():
+    # One directory per run, so runs never pick up each other's connections.
+    # It lives in /tmp rather than the user's cache dir, because socket paths
+    # have to be short.
+    return Path(tempfile.mkdtemp(prefix="si-", dir="/tmp"))
+
+
+def stop_ssh_masters(control_dir):
+    for socket_path in Path(control_dir).iterdir():
+        LOGGER.debug("stopping SSH master: %s", socket_path)
+        # the host is required, but unused when ControlPath has no tokens
+        subprocess.run(
+            ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "localhost"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+
+    shutil.rmtree(control_dir, ignore_errors=True)
 
 
 def get_localshell(timeout_seconds):
-    with disable_color():
-        shell = LocalShell(timeout=timeout_seconds)
-        shell.login()
-        return shell
+    shell = LocalShell(timeout=timeout_seconds)
+    shell.login()
+    return shell
 
 
 class RunnerEvent(enum.Enum):
@@ -231,29 +295,54 @@ class RunnerEvent(enum.Enum):
     ERROR = enum.auto()
 
 
+@functools.lru_cache(maxsize=1024)
+def _compile_expected(pattern):
+    # re has a cache of its own, but it's small and shared with everything
+    # else. Specs often check the same pattern over and over (examples,
+    # fixtures, includes).
+    return re.compile(pattern, re.MULTILINE)
+
+
 class ShellRunner:
     def __init__(self, ssh_config, context):
         self.sessions = {}
         self.reporters = []
         self.ssh_config = ssh_config
         self.context = context
+        self.ssh_control_dir = None
+
+        # per kind of host: how sessions are told apart and how to create one
+        self.session_key_builders = {
+            "local": self._get_local_session_key,
+            "remote": self._get_remote_session_key,
+        }
+        self.session_factories = {
+            "local": self._make_local_session,
+            "remote": self._make_remote_session,
+        }
+
+    def _get_local_session_key(self, cmd):
+        # ignore username, if we're operating locally
+        return (
+            "local",
+            cmd.session_name,
+        )
+
+    def _get_remote_session_key(self, cmd):
+        return (
+            self.ssh_config["server"],
+            self.ssh_config["port"],
+            cmd.user,
+            cmd.session_name,
+        )
 
     def _get_session_key(self, cmd):
-        if cmd.host == "local":
-            # ignore username, if we're operating locally
-            return (
-                "local",
-                cmd.session_name,
-            )
-        elif cmd.host == "remote":
-            return (
-                self.ssh_config["server"],
-                self.ssh_config["port"],
-                cmd.user,
-                cmd.session_name,
-            )
-        else:
-            raise NotImplementedError(f"Unknown host: {cmd.host}")
+        try:
+            build_key = self.session_key_builders[cmd.host]
+        except KeyError:
+            raise NotImplementedError(f"Unknown host: {cmd.host}") from None
+
+        return build_key(cmd)
 
     def _close_session(self, cmd):
         key = self._get_session_key(cmd)
@@ -267,24 +356,44 @@ class ShellRunner:
                 f"Session could not be closed, because it doesn't exist, command: {cmd}"
             )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for key, session in self.sessions.items():
+            LOGGER.debug("closing session: %s", key)
+            session.close()
+        self.sessions.clear()
+
+        if self.ssh_control_dir is not None:
+            stop_ssh_masters(self.ssh_control_dir)
+            self.ssh_control_dir = None
+
+    def _make_local_session(self, cmd, timeout_seconds):
+        LOGGER.debug("new local shell session")
+        return get_localshell(timeout_seconds)
+
+    def _make_remote_session(self, cmd, timeout_seconds):
+        ssh_config = {
+            **self.ssh_config,
+            "username": cmd.user,
+            "server": self.ssh_config["server"],
+            "port": self.ssh_config["port"],
+        }
+        LOGGER.debug("connecting via SSH: %s", ssh_config)
+        if self.ssh_control_dir is None:
+            self.ssh_control_dir = get_ssh_control_dir()
+        return get_ssh_session(ssh_config, timeout_seconds, self.ssh_control_dir)
+
     def _make_session(self, key, cmd, timeout_seconds):
         LOGGER.debug("creating session: %s", key)
-        if cmd.host == "local":
-            LOGGER.debug("new local shell session")
-            session = self.sessions[key] = get_localshell(timeout_seconds)
-        else:
-            ssh_config = {
-                **self.ssh_config,
-                "username": cmd.user,
-                "server": self.ssh_config["server"],
-                "port": self.ssh_config["port"],
-            }
-            LOGGER.debug("connecting via SSH: %s", ssh_config)
-            session = get_ssh_session(ssh_config, timeout_seconds)
+        session = self.session_factories[cmd.host](cmd, timeout_seconds)
 
         if logging.root.level == logging.DEBUG:
-            # use .buffer here, because pexpect wants to write bytes, not strs
-            session.logfile = sys.stdout.buffer
+            session.logfile = sys.stdout
 
         return session
 
@@ -295,7 +404,7 @@ class ShellRunner:
             session = _get_session(cmd)
             session.sendline("echo a")
             session.prompt()
-            assert session.before.decode() == "a"
+            assert session.before == "a"
 
         If cmd.host is "local", this opens a shell session as the current user
         on the current machine. Username and port are ignored. If server is
@@ -336,7 +445,7 @@ class ShellRunner:
         if cmd.assert_mode == AssertMode.LITERAL:
             output_matches = command_output == cmd.expected
         elif cmd.assert_mode == AssertMode.REGEX:
-            output_matches = re.search(cmd.expected, command_output, re.MULTILINE)
+            output_matches = _compile_expected(cmd.expected).search(command_output)
         elif cmd.assert_mode == AssertMode.IGNORE:
             output_matches = True
         else:
@@ -375,7 +484,7 @@ class ShellRunner:
 
     def _run_command(self, session, cmd):
         try:
-            command_output = session.run_command(cmd.command)
+            command_output, returncode = session.run_command(cmd.command)
         except TimeoutException as ex:
             self.report(
                 RunnerEvent.ERROR,
@@ -387,22 +496,7 @@ class ShellRunner:
             )
             return False
 
-        try:
-            rc_output = session.run_command("echo $?")
-        except TimeoutException as ex:
-            self.report(
-                RunnerEvent.ERROR,
-                cmd,
-                {
-                    "message": "timeout, could not find prompt for return code",
-                    "actual": ex.output_so_far,
-                },
-            )
-            return False
-
-        rc_output = int(rc_output)
-
-        return self._check_result(cmd, command_output, int(rc_output))
+        return self._check_result(cmd, command_output, returncode)
 
     def run(self, specfile: Specfile, outer_used_sessions=None):
         if outer_used_sessions:
@@ -461,9 +555,7 @@ class ShellRunner:
 
                     if session not in used_sessions:
                         used_sessions.add(session)
-                        session.set_environment(specfile.environment)
-                        session.set_environment(self.context)
-                        session.push_state()
+                        session.push_state(env={**specfile.environment, **self.context})
 
                     if not self._run_command(session, cmd):
                         self.report(RunnerEvent.RUN_FAILED, None, {})
@@ -52,6 +52,16 @@ def make_stream(lines, frontmatter=None):
             {},
             "% echo ab\na\nb\n",
         ),
+        (
+            "---\r\n{'a': 1}\r\n---\r\na\r\n",
+            {"a": 1},
+            "a\r\n",
+        ),
+        (
+            "---\nsomething: |\n  ---\n---\na\n",
+            {"something": "---\n"},
+            "a\n",
+        ),
     ],
 )
 def test_parse_yaml_multidoc(input, frontmatter, tests):
@@ -274,6 +284,32 @@ def test_user_reuse():
     assert commands[5].host == "somehost"
 
 
+def test_user_reuse_python():
+    specfile = parse(
+        "/dev/null",
+        make_stream(
+            [
+                "[someuser@somehost]$ ls",
+                "% ls",
+                "! print(1)",
+                "$ ls",
+                "! print(2)",
+            ]
+        ),
+    )
+    commands, errors = (specfile.commands, specfile.errors)
+
+    assert len(errors) == 0
+
+    # python commands reuse user and host of the last command of any mode
+    assert commands[2].user == "root"
+    assert commands[2].host == "remote"
+    assert commands[3].user == "someuser"
+    assert commands[3].host == "somehost"
+    assert commands[4].user == "someuser"
+    assert commands[4].host == "somehost"
+
+
 def test_empty():
     specfile = parse("/dev/null", StringIO(""))
     commands, errors = (specfile.commands, specfile.errors)
@@ -392,6 +428,26 @@ def test_include(ispec_path, include_dirs, include_path):
     assert commands[2].source_line_no == 4
 
 
+def test_include_twice():
+    path = Path(__file__).parent / "virtual.ispec"
+    specfile = parse(
+        path,
+        make_stream(
+            [
+                "<data/test.ispec",
+                "<data/test.ispec",
+            ]
+        ),
+    )
+    commands, errors = (specfile.commands, specfile.errors)
+
+    assert len(errors) == 0
+    assert len(commands) == 2
+    assert commands[0] == commands[1]
+    # each include must get its own commands
+    assert commands[0] is not commands[1]
+
+
 def test_environment():
     path = Path(__file__).parent / "virtual.ispec"
     specfile = parse(
@@ -590,3 +646,53 @@ def test_fixture():
     assert len(specfile.fixture_specfile_pre.commands) == 3
     assert specfile.fixture_specfile_post
     assert len(specfile.fixture_specfile_post.commands) == 1
+
+
+def test_specfile_copy():
+    specfile = parse(
+        Path(__file__).parent / "some.ispec",
+        make_stream(
+            [
+                "---",
+                "fixture: e2e/fixtures/create_user",
+                "settings:",
+                "  timeout_seconds: 99",
+                "---",
+                "% ls",
+                "file",
+            ]
+        ),
+    )
+
+    copy = specfile.copy()
+
+    assert copy.commands == specfile.commands
+    assert copy.commands[0] is not specfile.commands[0]
+    assert copy.environment == specfile.environment
+    assert copy.fixture_specfile_pre == specfile.fixture_specfile_pre
+    assert copy.fixture_specfile_pre is not specfile.fixture_specfile_pre
+    assert copy.fixture_specfile_post == specfile.fixture_specfile_post
+    assert copy.settings == specfile.settings
+    assert copy.settings is not specfile.settings
+    assert copy.settings.timeout_seconds == 99
+
+
+def test_as_example():
+    specfile = parse(
+        "/dev/null",
+        make_stream(
+            [
+                "% echo {GREETING} {{literal}}",
+                "{GREETING} {{literal}}",
+            ]
+        ),
+    )
+
+    example = specfile.as_example({"GREETING": "hello"})
+
+    assert example.applied_example == {"GREETING": "hello"}
+    assert example.commands[0].command == "echo hello {literal}"
+    assert example.commands[0].line == "% echo hello {literal}"
+    assert example.commands[0].expected == "hello {literal}\n"
+    # the original is left untouched
+    assert specfile.commands[0].command == "echo {GREETING} {{literal}}"
@@ -1,4 +1,5 @@
 import os
+import re
 from pathlib import Path
 
 import pytest
@@ -13,8 +14,9 @@ from shellinspector.runner import RemoteShell
 from shellinspector.runner import RunnerEvent
 from shellinspector.runner import ShellinspectorPyContext
 from shellinspector.runner import ShellRunner
-from shellinspector.runner import disable_color
 from shellinspector.runner import get_localshell
+from shellinspector.runner import get_ssh_control_dir
+from shellinspector.runner import get_ssh_options
 from shellinspector.runner import get_ssh_session
 from shellinspector.runner import run_in_file
 
@@ -28,6 +30,8 @@ def ssh_key_path():
 
 @pytest.fixture
 def make_runner():
+    runners = []
+
     def make_runner(ssh_config=None, context=None):
         ssh_config = ssh_config or {}
         context = context or {}
@@ -39,10 +43,14 @@ def make_runner():
 
         runner = ShellRunner(ssh_config, context)
         runner.add_reporter(rep)
+        runners.append(runner)
 
         return runner, events
 
-    return make_runner
+    yield make_runner
+
+    for runner in runners:
+        runner.close()
 
 
 @pytest.fixture
@@ -55,96 +63,83 @@ def ssh_config(ssh_key_path):
     }
 
 
-def test_disable_color():
-    if "TERM" in os.environ:
-        old_term = os.environ["TERM"]
-        os.environ["TERM"] = "something"
-    else:
-        old_term = None
-
-    with disable_color():
-        assert os.environ["TERM"] == "dumb"
-
-    if old_term is not None:
-        assert os.environ["TERM"] == "something"
-        os.environ["TERM"] = old_term
-    else:
-        assert "TERM" not in os.environ
-
-
-def test_disable_color_no_term():
-    if "TERM" in os.environ:
-        old_term = os.environ["TERM"]
-        del os.environ["TERM"]
-    else:
-        old_term = None
-
-    assert "TERM" not in os.environ
-
-    with disable_color():
-        assert os.environ["TERM"] == "dumb"
-
-    assert "TERM" not in os.environ
-
-    if old_term is not None:
-        os.environ["TERM"] = old_term
-
-
 def test_localshell():
-    with disable_color():
-        shell = LocalShell(timeout=2)
-        shell.login()
+    shell = LocalShell(timeout=2)
+    shell.login()
     shell.sendline("echo a && echo b")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "a\r\nb\r\n"
+    assert shell.before == "a\r\nb\r\n"
     shell.sendline("echo c")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "c\r\n"
+    assert shell.before == "c\r\n"
+
+
+def test_localshell_no_color():
+    shell = LocalShell(timeout=2)
+    shell.login()
+    shell.sendline("echo $TERM")
+    assert shell.prompt(), shell.before
+    assert shell.before.strip() == "dumb"
 
 
 def test_localshell_state():
-    with disable_color():
-        shell = LocalShell(timeout=2)
-        shell.login()
+    shell = LocalShell(timeout=2)
+    shell.login()
 
     shell.sendline("echo $OUTERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == ""
+    assert shell.before.strip() == ""
 
     shell.sendline("export OUTERVAR=1")
     assert shell.prompt(), shell.before
     shell.sendline("echo $OUTERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "1"
+    assert shell.before.strip() == "1"
 
     shell.push_state()
 
     shell.sendline("echo $OUTERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "1"
+    assert shell.before.strip() == "1"
 
     shell.sendline("export INNERVAR=1")
     assert shell.prompt(), shell.before
 
     shell.sendline("echo $INNERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "1"
+    assert shell.before.strip() == "1"
 
     shell.pop_state()
 
     shell.sendline("echo $OUTERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "1"
+    assert shell.before.strip() == "1"
 
     shell.sendline("echo $INNERVAR")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == ""
+    assert shell.before.strip() == ""
+
+
+def test_localshell_state_environment():
+    shell = LocalShell(timeout=2)
+    shell.login()
+
+    shell.push_state(env={"VAR1": "a  b", "VAR2": 1})
+
+    shell.sendline("echo $VAR1 $VAR2")
+    assert shell.prompt(), shell.before
+    assert shell.before.strip() == "a b 1"
+
+    shell.pop_state()
+
+    shell.sendline("echo $VAR1")
+    assert shell.prompt(), shell.before
+    assert shell.before.strip() == ""
 
 
 def test_localshell_state_kill_session():
-    with disable_color():
-        shell = LocalShell(timeout=2)
-        shell.login()
+    shell = LocalShell(timeout=2)
+    shell.login()
 
     shell.push_state()
 
@@ -156,9 +151,8 @@ def test_localshell_state_kill_session():
 
 
 def test_localshell_set_environment():
-    with disable_color():
-        shell = LocalShell(timeout=2)
-        shell.login()
+    shell = LocalShell(timeout=2)
+    shell.login()
 
     shell.set_environment(
         {
@@ -169,30 +163,73 @@ def test_localshell_set_environment():
 
     shell.sendline("echo $VAR1")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "aa"
+    assert shell.before.strip() == "aa"
 
     shell.sendline("echo $VAR2")
     assert shell.prompt(), shell.before
-    assert shell.before.decode().strip() == "bb"
+    assert shell.before.strip() == "bb"
+
+
+def test_localshell_get_environment():
+    shell = LocalShell(timeout=2)
+    shell.login()
+
+    shell.sendline("export SPACES='a  b' NEWLINE=$'a\\nb'")
+    assert shell.prompt(), shell.before
+
+    env = shell.get_environment()
+    assert env["HOME"] == os.environ["HOME"]
+    assert env["SPACES"] == "a  b"
+    assert env["NEWLINE"] == "a\nb"
+
+
+def test_localshell_run_command():
+    shell = LocalShell(timeout=2)
+    shell.login()
+
+    assert shell.run_command("echo a && echo b") == ("a\nb\n", 0)
+    assert shell.run_command("echo c; (exit 3)") == ("c\n", 3)
+
+    # the return code survives nested shells
+    shell.push_state()
+    assert shell.run_command("false") == ("", 1)
+    shell.pop_state()
 
 
 def test_remoteshell(ssh_config):
-    with disable_color():
-        shell = RemoteShell(timeout=2)
-        shell.login(**ssh_config)
+    shell = RemoteShell(timeout=2)
+    shell.login(**ssh_config)
 
     shell.sendline("echo a && echo b")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "a\r\nb\r\n"
+    assert shell.before == "a\r\nb\r\n"
     shell.sendline("echo c")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "c\r\n"
+    assert shell.before == "c\r\n"
+
+
+@pytest.mark.parametrize(
+    "prompt_set,returncode_var",
+    [
+        ("PROMPT_SET_SH", "$?"),
+        ("PROMPT_SET_CSH", "%?"),
+    ],
+)
+def test_remoteshell_prompt_returncode(prompt_set, returncode_var):
+    shell = RemoteShell()
+    # render the prompt the way the shell would after a failed command
+    prompt = getattr(shell, prompt_set).split("'")[1]
+    prompt = prompt.replace(returncode_var, "1").replace("\\$", "$")
+
+    match = re.match(shell.UNIQUE_PROMPT, prompt)
+
+    assert match, prompt
+    assert match.group("returncode") == "1"
 
 
 def test_remoteshell_get_environment(ssh_config):
-    with disable_color():
-        shell = RemoteShell(timeout=2)
-        shell.login(**ssh_config)
+    shell = RemoteShell(timeout=2)
+    shell.login(**ssh_config)
 
     shell.sendline("export SPACES='a b'")
     assert shell.prompt(), shell.before
@@ -207,14 +244,14 @@ def test_get_localshell():
     shell = get_localshell(5)
     shell.sendline("echo a")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "a\r\n"
+    assert shell.before == "a\r\n"
 
 
 def test_get_ssh_session(ssh_config):
     shell = get_ssh_session(ssh_config, 5)
     shell.sendline("echo a")
     assert shell.prompt(), shell.before
-    assert shell.before.decode() == "a\r\n"
+    assert shell.before == "a\r\n"
 
 
 def test_add_reporter():
@@ -505,7 +542,7 @@ def test_get_session(make_runner, ssh_config, user, host, expected_class):
 
     session1.sendline("echo a")
     assert session1.prompt()
-    assert session1.before.decode().strip() == "a"
+    assert session1.before.strip() == "a"
 
     session2 = runner._get_session(cmd, 5)
     assert id(session1) == id(session2)
@@ -746,9 +783,10 @@ def test_environment(make_runner, ssh_config):
 
 
 class FakeSession(RemoteShell):
-    def __init__(self, prompt_works, before):
+    def __init__(self, prompt_works, before, returncodes):
         self._prompt_works = prompt_works
         self._before = before
+        self._returncodes = returncodes
         self._lines = []
         self._closed = False
 
@@ -762,12 +800,16 @@ class FakeSession(RemoteShell):
                 + ",".join(self._lines)
             )
         self.before = self._before.pop(0)
+        # the return code is part of the prompt, see RemoteShell.__init__
+        self.match = re.match(
+            r"(?P<returncode>[0-9]+)", str(self._returncodes.pop(0))
+        )
         return self._prompt_works.pop(0)
 
     def close(self):
         self._closed = True
 
-    def push_state(self):
+    def push_state(self, env=None):
         pass
 
     def pop_state(self):
@@ -778,42 +820,42 @@ class FakeSession(RemoteShell):
 
 
 @pytest.mark.parametrize(
-    "prompt_works,actual_output,expected_result,expected_events",
+    "prompt_works,actual_output,returncodes,expected_result,expected_events",
     (
         (
-            [True, True],
-            [b"a", b"0"],
+            [True],
+            ["a"],
+            [0],
             True,
             [
                 (RunnerEvent.COMMAND_PASSED, {"returncode": 0, "actual": "a"}),
             ],
         ),
         (
-            [False, True],
-            [b"a", b"0"],
+            [True],
+            ["a"],
+            [1],
             False,
             [
                 (
-                    RunnerEvent.ERROR,
-                    {
-                        "message": "timeout, could not find prompt for command",
-                        "actual": "a",
-                    },
+                    RunnerEvent.COMMAND_FAILED,
+                    {"returncode": 1, "actual": "a", "reasons": {"returncode"}},
                 ),
             ],
         ),
         (
-            [True, False],
-            [b"a", b"0"],
+            [False],
+            ["a"],
+            [0],
             False,
             [
                 (
                     RunnerEvent.ERROR,
                     {
-                        "message": "timeout, could not find prompt for return code",
-                        "actual": "0",
+                        "message": "timeout, could not find prompt for command",
+                        "actual": "a",
                     },
-                )
+                ),
             ],
         ),
     ),
@@ -823,10 +865,11 @@ def test_run_command(
     command_local_echo_literal_fail,
     prompt_works,
     actual_output,
+    returncodes,
     expected_result,
     expected_events,
 ):
-    session = FakeSession(prompt_works, actual_output)
+    session = FakeSession(prompt_works, actual_output, returncodes)
     runner, events = make_runner()
     result = runner._run_command(session, command_local_echo_literal_fail)
     assert result == expected_result, events
@@ -840,11 +883,12 @@ def test_run_command(
 
 
 @pytest.mark.parametrize(
-    "prompt_works,actual_output,expected_result,expected_events",
+    "prompt_works,actual_output,returncodes,expected_result,expected_events",
     (
         (
-            [True, True],
-            [b"a", b"0"],
+            [True],
+            ["a"],
+            [0],
             True,
             [
                 (RunnerEvent.COMMAND_STARTING, "echo a", {}),
@@ -857,8 +901,9 @@ def test_run_command(
             ],
         ),
         (
-            [True, True],
-            [b"a", b"1"],
+            [True],
+            ["a"],
+            [1],
             False,
             [
                 (RunnerEvent.COMMAND_STARTING, "echo a", {}),
@@ -877,11 +922,12 @@ def test_run1(
     command_local_echo_literal_fail,
     prompt_works,
     actual_output,
+    returncodes,
     expected_result,
     expected_events,
 ):
     runner, events = make_runner()
-    session = FakeSession(prompt_works, actual_output)
+    session = FakeSession(prompt_works, actual_output, returncodes)
     runner._get_session = lambda cmd, timeout: session
     specfile = Specfile("virtual.ispec")
     specfile.commands = [command_local_echo_literal_fail]
@@ -946,3 +992,25 @@ def test_run_in_file_non_call():
         run_in_file(Path(__file__).parent / "e2e/700_python.ispec.py", None, "1 + 1")
 
     assert "Only function calls are supported" in str(ex)
+
+
+def test_runner_close_stops_ssh_masters():
+    with ShellRunner({}, {}) as runner:
+        runner.ssh_control_dir = get_ssh_control_dir()
+        control_dir = runner.ssh_control_dir
+        assert control_dir.exists()
+
+    assert not control_dir.exists()
+    assert runner.ssh_control_dir is None
+
+
+def test_get_ssh_options():
+    control_dir = get_ssh_control_dir()
+    try:
+        options = get_ssh_options(control_dir)
+        assert options["ControlPath"] == f"{control_dir}/%C"
+    finally:
+        control_dir.rmdir()
+
+    assert get_ssh_options(None) == {}
+    assert get_ssh_options("/home/" + "a" * 40) == {}